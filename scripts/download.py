@@ -1,17 +1,23 @@
 import asyncio
 from aiohttp_retry import RetryClient, ExponentialRetry
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 import zipfile
+import io
+import itertools
 import datetime
 import os
 import logging
 import re
 import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from tqdm.asyncio import tqdm
 import yaml
 import pathlib
 from aiolimiter import AsyncLimiter
-from aiohttp import ClientError
+from diskcache import Cache
+from functools import lru_cache
+from aiohttp import ClientError, TCPConnector
 
 # Explicitly define the project root assuming the script is in the 'scripts' subdirectory of the project root
 project_root = pathlib.Path(__file__).resolve().parent.parent
@@ -33,77 +39,155 @@ base_url = config["base_url"]
 
 # Regex patterns for target files. Only download region files for now.
 target_file_patterns = config["target_file_patterns"]
+# Combined into one compiled alternation so each link is matched once
+target_file_regex = re.compile('|'.join(f'(?:{pattern})' for pattern in target_file_patterns))
+
+# On-disk cache of index page links keyed by URL, shared across runs
+link_cache = Cache(str(project_root / ".cache"))
+
+# Caps in-flight requests to nemweb; the limiter only caps how often new requests start
+HOST_SEM = asyncio.Semaphore(config.get("max_connections_per_host", 20))
+
+# Size of the chunks read from the response body when streaming downloads
+CHUNK_SIZE = 64 * 1024
 
 def configure_logging(level):
     logging.basicConfig(level=level, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Shared client and limiter, created on first use and closed at the end of main
+_session = None
+
 # Async session setup with retry and rate limiting
 async def setup_session():
-    retry_options = ExponentialRetry(attempts=config["max_attempts"])
-    client = RetryClient(retry_options=retry_options)
-    limiter = AsyncLimiter(max_rate=config["max_requests_per_second"], time_period=1)
-    return client, limiter
+    global _session
+    if _session is None:
+        retry_options = ExponentialRetry(attempts=config["max_attempts"])
+        connector = TCPConnector(limit=config.get("max_connections", 64),
+                                 limit_per_host=config.get("max_connections_per_host", 20),
+                                 keepalive_timeout=75,
+                                 enable_cleanup_closed=True)
+        client = RetryClient(retry_options=retry_options, connector=connector)
+        limiter = AsyncLimiter(max_rate=config["max_requests_per_second"], time_period=1)
+        _session = (client, limiter)
+    return _session
 
-async def fetch_file_links(client, limiter, url):
+async def fetch_hrefs(client, limiter, url):
+    # Raw hrefs are cached rather than filtered links, so edits to target_file_patterns apply on the next run
+    cache_key = ('hrefs', url)
+    cached_hrefs = link_cache.get(cache_key)
+    if cached_hrefs is not None:
+        return cached_hrefs
     attempts = 0
     max_attempts = 3  # or fetch from config
     while attempts < max_attempts:
         try:
-            async with limiter:
-                async with client.get(url) as response:
-                    if response.status == 200:
-                        text = await response.text()
-                        soup = BeautifulSoup(text, 'html.parser')
-                        links = [f"{base_url}{link.get('href').strip()}" if link.get('href').startswith('/') else link.get('href').strip()
-                                 for link in soup.find_all('a') if any(re.match(pattern, link.get('href').strip()) for pattern in target_file_patterns)]
-                        return links
-                    else:
-                        logging.error(f"Failed to access {url} with status {response.status}")
+            async with HOST_SEM:
+                async with limiter:
+                    async with client.get(url) as response:
+                        if response.status == 200:
+                            text = await response.text()
+                            tree = LexborHTMLParser(text)
+                            hrefs = [(node.attributes.get('href') or '').strip() for node in tree.css('a')]
+                            link_cache.set(cache_key, hrefs, expire=config.get("link_cache_expiry", 3600))
+                            return hrefs
+                        else:
+                            logging.error(f"Failed to access {url} with status {response.status}")
         except ClientError as e:
             logging.error(f"Client error when accessing {url}: {e}")
         attempts += 1
         logging.info(f"Retrying {url} ({attempts}/{max_attempts})")
     return []
 
-async def download_file(client, limiter, link, base_directory):
+async def fetch_file_links(client, limiter, url):
+    hrefs = await fetch_hrefs(client, limiter, url)
+    return [f"{base_url}{href}" if href.startswith('/') else href
+            for href in hrefs if target_file_regex.match(href)]
+
+def extract_zip_bytes(data, base_directory):
+    # Runs in a worker process so DEFLATE decompression does not hold up the download loop.
+    # Members are extracted to a temporary directory first and moved into place once complete,
+    # so an interrupted run never leaves a truncated CSV that the skip check would accept.
+    with tempfile.TemporaryDirectory(dir=base_directory) as temp_directory:
+        with zipfile.ZipFile(io.BytesIO(data), 'r') as zip_ref:
+            zip_ref.extractall(temp_directory)
+        for root, _, files in os.walk(temp_directory):
+            for name in files:
+                temp_path = os.path.join(root, name)
+                target_path = os.path.join(base_directory, os.path.relpath(temp_path, temp_directory))
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                os.replace(temp_path, target_path)
+
+def write_bytes(file_path, data):
+    # Write to a temporary file and move it into place once complete, so an interrupted
+    # write never leaves a truncated file that the skip check would accept
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path))
     try:
-        async with limiter:
-            async with client.get(link) as response:
-                if response.status == 200:
-                    file_name = link.split('/')[-1]
-                    file_path = os.path.join(base_directory, file_name)
-                    try:
-                        with open(file_path, 'wb') as f:
-                            f.write(await response.read())
-                    except IOError as e:
-                        logging.error(f"Failed to write to file {file_path}: {e}")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+async def download_file(client, limiter, link, base_directory, executor):
+    file_name = link.split('/')[-1]
+    file_path = os.path.join(base_directory, file_name)
+    # Skip files already fetched by a previous run; archives are checked by the CSV they extract to
+    expected_path = re.sub(r'\.zip$', '.CSV', file_path)
+    if os.path.exists(expected_path):
+        logging.debug(f"Skipping {link}, {expected_path} already exists")
+        return True, link
+    try:
+        async with HOST_SEM:
+            async with limiter:
+                async with client.get(link) as response:
+                    if response.status != 200:
+                        logging.error(f"Failed to download {link} with status {response.status}")
                         return False, link
-                    if file_path.endswith('.zip'):
-                        try:
-                            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                                zip_ref.extractall(os.path.dirname(file_path))
-                            os.remove(file_path)
-                        except zipfile.BadZipFile as e:
-                            logging.error(f"Zip extraction failed for {file_path}: {e}")
-                            return False, link
-                    return True, link
-                else:
-                    logging.error(f"Failed to download {link} with status {response.status}")
-                    return False, link
+                    # Stream the body into memory so archives can be extracted without an intermediate file
+                    buffer = io.BytesIO()
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        buffer.write(chunk)
+        # The connection is released before extraction so it can serve the next download
+        if file_path.endswith('.zip'):
+            try:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(executor, extract_zip_bytes, buffer.getvalue(), base_directory)
+            except zipfile.BadZipFile as e:
+                logging.error(f"Zip extraction failed for {file_path}: {e}")
+                return False, link
+        else:
+            try:
+                # Write from a worker thread so the event loop keeps serving other downloads
+                await asyncio.to_thread(write_bytes, file_path, buffer.getbuffer())
+            except IOError as e:
+                logging.error(f"Failed to write to file {file_path}: {e}")
+                return False, link
+        return True, link
     except Exception as e:
         logging.error(f"Error downloading {link}: {e}")
         return False, link
-            
-async def download_files(links, base_directory):
-    client, limiter = await setup_session()
-    tasks = [download_file(client, limiter, link, base_directory) for link in links]
-    results = []
-    for f in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
-        result = await f
-        results.append(result)
-    await client.close()
+
+async def download_files(client, limiter, links, base_directory, max_workers=None):
+    # Downloads are I/O-bound, so allow several in flight per core unless configured otherwise
+    if max_workers is None:
+        max_workers = config.get("max_workers") or min(32, (os.cpu_count() or 4) * 5)
+    semaphore = asyncio.Semaphore(max_workers)
+
+    # Zip extraction is CPU-bound, so it gets its own process pool sized to the machine
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        async def bounded_download(link):
+            async with semaphore:
+                return await download_file(client, limiter, link, base_directory, executor)
+
+        tasks = [bounded_download(link) for link in links]
+        results = []
+        for f in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            result = await f
+            results.append(result)
     return [url for success, url in results if not success]
 
+@lru_cache(maxsize=None)
 def generate_urls(start_year, start_month, end_year, end_month):
     base_url = "https://nemweb.com.au/Data_Archive/Wholesale_Electricity/MMSDM/"
     start_date = datetime.date(start_year, start_month, 1)
@@ -122,7 +206,8 @@ def generate_urls(start_year, start_month, end_year, end_month):
         else:
             current_date = datetime.date(current_date.year, current_date.month + 1, 1)
 
-    return urls
+    # Returned as a tuple so the cached result cannot be mutated by callers
+    return tuple(urls)
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Download historical market data from AEMO.')
@@ -141,27 +226,30 @@ def setup_directories(base_directory):
 async def process_downloads(start_year, start_month, end_year, end_month, base_directory):
     urls = generate_urls(start_year, start_month, end_year, end_month)
     client, limiter = await setup_session()
-    all_links = []
-    for url in urls:
-        links = await fetch_file_links(client, limiter, url)
-        all_links.extend(links)
-    failed_downloads = await download_files(all_links, base_directory)
+    # Fetch all month listings concurrently; the limiter still caps the request rate
+    nested_links = await asyncio.gather(*(fetch_file_links(client, limiter, url) for url in urls))
+    all_links = list(itertools.chain.from_iterable(nested_links))
+    failed_downloads = await download_files(client, limiter, all_links, base_directory)
     if failed_downloads:
         logging.error(f"Failed to download the following files: {failed_downloads}")
     else:
         logging.info("All files downloaded successfully.")
-    await client.close()
 
 async def main():
     args = parse_arguments()
     configure_logging(args.log_level or config.get("log_level", "INFO"))
     base_directory = args.data_dir or data_directory
     setup_directories(base_directory)
-    await process_downloads(args.start_year or config.get("start_year"),
-                            args.start_month or config.get("start_month"),
-                            args.end_year or config.get("end_year"),
-                            args.end_month or config.get("end_month"),
-                            base_directory)
+    client, _ = await setup_session()
+    try:
+        await process_downloads(args.start_year or config.get("start_year"),
+                                args.start_month or config.get("start_month"),
+                                args.end_year or config.get("end_year"),
+                                args.end_month or config.get("end_month"),
+                                base_directory)
+    finally:
+        await client.close()
+        link_cache.close()
 
 if __name__ == "__main__":
     try:
@@ -1,10 +1,13 @@
 import numpy as np
-from dask_ml.preprocessing import StandardScaler
-import os
+import pandas as pd
 import pathlib
 import logging
 import yaml
+import dask
 import dask.dataframe as dd
+from dask.dataframe.utils import clear_known_categories
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from logging.handlers import RotatingFileHandler
 
 # Setup logging
@@ -40,12 +43,48 @@ config_path = project_root / "configs/columns_config.yaml"
 with open(config_path, "r") as f:
     config = yaml.safe_load(f)
 
+# Dtypes treated as numerical features by the statistics and standardization steps
+NUMERIC_DTYPES = ['float32', 'float64', 'int32', 'int64']
+
+def skip_invalid_row(row):
+    # MMSDM files end with a short 'C,END OF REPORT' row that does not match the header;
+    # only comment rows are dropped, any other malformed row still fails the load
+    return 'skip' if row.text.startswith('C,') else 'error'
+
+def infer_column_types(path, date_columns, sample_rows=1000):
+    # Infer one schema from the head of a file so every partition is parsed with the same types
+    sample = pd.read_csv(path, header=1, nrows=sample_rows)
+    column_types = {}
+    for col, dtype in sample.dtypes.items():
+        if col in date_columns:
+            # Read as text and leave conversion to parse_dates, which coerces malformed values to NaT
+            column_types[col] = pa.string()
+        elif pd.api.types.is_numeric_dtype(dtype):
+            # Parse all numbers as float32 so missing values never change a column's dtype between files
+            column_types[col] = pa.float32()
+        else:
+            # Remaining text columns hold a handful of distinct values and are loaded as categoricals
+            column_types[col] = pa.dictionary(pa.int32(), pa.string())
+    return column_types
+
+def read_csv_file(path, column_types):
+    # Parse a single file with the multithreaded pyarrow reader, skipping the leading 'C' comment row
+    read_options = pacsv.ReadOptions(skip_rows=1, use_threads=True)
+    parse_options = pacsv.ParseOptions(invalid_row_handler=skip_invalid_row)
+    convert_options = pacsv.ConvertOptions(column_types=column_types)
+    table = pacsv.read_csv(path, read_options=read_options, parse_options=parse_options,
+                           convert_options=convert_options)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
 def load_data(directory, date_columns):
     try:
         logging.info("Loading data from directory: %s", directory)
-        files = [os.path.join(directory, file) for file in os.listdir(directory) if file.endswith('.CSV')]
+        # Sorted so partitions come out in the same order on every run
+        files = sorted(str(path) for path in pathlib.Path(directory).glob('*.CSV'))
         logging.info("Number of files to process: %d", len(files))  # Log the number of files
-        data = dd.read_csv(files, header=1, assume_missing=True)
+        column_types = infer_column_types(files[0], date_columns)
+        meta = clear_known_categories(pa.schema(list(column_types.items())).empty_table().to_pandas())
+        data = dd.from_map(read_csv_file, files, column_types=column_types, meta=meta, label='read-csv')
         logging.info("Data loaded successfully")
     except Exception as e:
         logging.error("Failed to load data from directory %s: %s", directory, e, exc_info=True)
@@ -62,30 +101,26 @@ def parse_dates(data, date_columns):
         data[col] = dd.to_datetime(data[col], errors='coerce')
     return data
 
+def time_features_partition(df):
+    # Derive every time feature from one .dt accessor so each partition is touched once.
+    # Nullable integer dtypes keep rows with a missing RUN_DATETIME as <NA> instead of failing the cast.
+    dt = df['RUN_DATETIME'].dt
+    return df.assign(hour=dt.hour.astype('UInt8'),
+                     day_of_week=dt.dayofweek.astype('UInt8'),
+                     month=dt.month.astype('UInt8'),
+                     year=dt.year.astype('UInt16'))
+
 def add_time_features(data):
     logging.info("Adding time features")
-    data['hour'] = data['RUN_DATETIME'].dt.hour
-    data['day_of_week'] = data['RUN_DATETIME'].dt.dayofweek
-    data['month'] = data['RUN_DATETIME'].dt.month
-    data['year'] = data['RUN_DATETIME'].dt.year
+    data = data.map_partitions(time_features_partition)
     return data
 
 def encode_categorical(data):
     logging.info("Encoding categorical columns")
-    categorical_cols = data.select_dtypes(include=['object']).columns
-    high_cardinality_cols = ['REGIONID']
-    low_cardinality_cols = [col for col in categorical_cols if col not in high_cardinality_cols]
-    
-    # Convert low cardinality columns to categorical dtype and encode
-    for col in low_cardinality_cols:
-        data[col] = data[col].astype('category').cat.as_known()
-        data[col] = data[col].cat.codes
-    
-    # Handle high cardinality columns separately if needed
-    for col in high_cardinality_cols:
-        data[col] = data[col].astype('category').cat.as_known()
-        data[col] = data[col].cat.codes
-    
+    categorical_cols = list(data.select_dtypes(include=['object', 'category']).columns)
+    # Learn the categories of every column in one pass, then replace each with compact integer codes
+    data = data.categorize(columns=categorical_cols)
+    data = data.assign(**{col: data[col].cat.codes.astype('int16') for col in categorical_cols})
     return data
 
 def keep_columns(data, columns_to_keep):
@@ -95,43 +130,54 @@ def keep_columns(data, columns_to_keep):
     logging.info("Unspecified columns dropped successfully")
     return data
 
-def handle_outliers(data):
-    logging.info("Handling outliers")
-    numerical_cols = data.select_dtypes(include=['float64', 'int64']).columns
-    for col in numerical_cols:
-        mean, std = data[col].mean(), data[col].std()
-        upper_limit = mean + 3 * std
-        lower_limit = mean - 3 * std
-        data[col] = np.clip(data[col], lower_limit, upper_limit)
-    return data
+def standardize_partition(df, lower, upper, mean, scale):
+    # Clip and scale all columns of a partition in place on a single contiguous float32 array
+    arr = np.ascontiguousarray(df.to_numpy(dtype='float32'))
+    np.clip(arr, lower, upper, out=arr)
+    arr -= mean
+    arr /= scale
+    return pd.DataFrame(arr, index=df.index, columns=df.columns)
+
+def compute_statistics(data):
+    logging.info("Computing column statistics")
+    numerical_cols = list(data.select_dtypes(include=NUMERIC_DTYPES).columns)
+    numeric = data[numerical_cols]
+    # Compute everything the later steps need in a single pass over the data
+    count, mean, std, total = dask.compute(numeric.count(), numeric.mean(), numeric.std(), numeric.shape[0])
+    # Filling gaps with the mean keeps the mean but shrinks the spread, so rescale std to the filled columns
+    # A column with a single value has no spread; treat it as constant rather than NaN
+    std = (std * np.sqrt((count - 1) / (total - 1))).fillna(0)
+    return mean, std
 
 from dask.diagnostics import ProgressBar
 
-def normalize_data(data):
-    logging.info("Normalizing data")
-    scaler = StandardScaler()
-    numerical_cols = data.select_dtypes(include=['float64', 'int64']).columns    
-    # Apply normalization
-    transformed_data = scaler.fit_transform(data[numerical_cols])
-    # Use assign to create a new DataFrame with the normalized columns
-    data = data.assign(**{col: transformed_data[col] for col in numerical_cols})    
+def standardize(data, mean, std):
+    logging.info("Clipping outliers and normalizing data")
+    numerical_cols = list(mean.index)
+    # Clip to three standard deviations, then scale with the same statistics instead of refitting a scaler
+    lower = (mean - 3 * std).to_numpy(dtype='float32')
+    upper = (mean + 3 * std).to_numpy(dtype='float32')
+    # Constant columns are left unscaled, as StandardScaler does
+    scale = std.where(std > 0, 1.0).to_numpy(dtype='float32')
+    standardized = data[numerical_cols].map_partitions(standardize_partition, lower, upper,
+                                                       mean.to_numpy(dtype='float32'), scale)
+    data = data.assign(**{col: standardized[col] for col in numerical_cols})
     return data
 
-def handle_missing_values(data):
+def handle_missing_values(data, mean):
     logging.info("Handling missing values")
-    # Select only numeric columns for filling missing values
-    numeric_cols = data.select_dtypes(include=['number']).columns
-    # Compute the mean for each numeric column and use fillna in a way that Dask can handle
-    for col in numeric_cols:
-        mean = data[col].mean().compute()  # Ensure computation of mean
-        data[col] = data[col].fillna(mean)  # Apply fillna on a column-by-column basis
+    # Fill all numeric columns with their precomputed means at once
+    data = data.fillna(mean.to_dict())
     return data
 
 def save_data(data, filepath):
     try:
         parquet_path = filepath.with_suffix('.parquet')
         logging.info("Saving data to %s", parquet_path)
-        data.to_parquet(parquet_path)  # Removed index=False
+        # ZSTD level 3 gives smaller files than Snappy at a similar encode speed; 256k-row groups suit downstream scans
+        data.to_parquet(parquet_path, engine='pyarrow', compression='zstd', compression_level=3,
+                        row_group_size=256_000, write_statistics=True, use_dictionary=True,
+                        write_metadata_file=True)
         logging.info("Data saved successfully in Parquet format")
     except Exception as e:
         logging.error("Failed to save data to %s: %s", parquet_path, e, exc_info=True)
@@ -152,11 +198,10 @@ def main():
         data = parse_dates(data, date_columns)
         data = add_time_features(data)
         data = keep_columns(data, columns_to_keep)
-        data = handle_missing_values(data)
-        data = data.persist()
-        data = handle_outliers(data)
+        mean, std = compute_statistics(data)
+        data = handle_missing_values(data, mean)
+        data = standardize(data, mean, std)
         data = data.persist()
-        data = normalize_data(data)
         data = encode_categorical(data)
         save_data(data, processed_data_path)
         logging.info("Preprocessing pipeline completed")